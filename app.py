@@ -8,16 +8,61 @@ Features:
 """
 
 
+import asyncio
+import hashlib
 import os
+import threading
+from collections.abc import Iterator
+import httpx
 import streamlit as st
-from openai import OpenAI
+import streamlit.components.v1 as components
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
 from streamlit_js_eval import streamlit_js_eval
+from async_stream import iter_in_loop, run_feedback
+
+# ---------- HTTP / streaming ----------
+# Upper bound on a hung stream (read/connect), so Stop never waits on a dead socket.
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+# Keep-alive pool shared by all requests of a client (HTTP/2 multiplexes on top of it).
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+# SDK-level retries (exponential backoff with jitter) for 429/5xx and connection errors.
+# Streams are only retried before the response starts, never after the first chunk.
+API_MAX_RETRIES = 5
+# Deltas per st.write_stream chunk start small (fast first paint) and grow up to the cap.
+STREAM_MIN_BATCH = 1
+STREAM_GROWTH_FACTOR = 3
+STREAM_MAX_BATCH = 25
+# Non-system messages sent with each interview request (the system prompt is always kept).
+API_HISTORY_WINDOW = 6
+
+# ---------- Feedback prompt ----------
+FEEDBACK_SYSTEM = (
+    "You are a helpful tool that provides feedback on an interviewee performance. "
+    "Before the Feedback give a score of 1 to 10.\n"
+    "Follow this format:\n"
+    "Overal Score: //Your score\n"
+    "Feedback: //Here you put your feedback\n"
+    "Give only the feedback do not ask any additional questins."
+)
+# The transcript is appended to this prefix at call time.
+FEEDBACK_USER_PREFIX = (
+    "This is the interview you need to evaluate. "
+    "Keep in mind that you are only a tool. "
+    "And you shouldn't engage in any converstation: "
+)
 
-# ---------- Page config ----------
-st.set_page_config(page_title="StreamlitChatMessageHistory", page_icon="💬")
-# ---------- UI polish ----------
-st.markdown(
-    """
+FEEDBACK_MODELS = ("gpt-4.1-mini", "gpt-4o", "gpt-4o-mini")
+FEEDBACK_MODEL_IDX = {v: i for i, v in enumerate(FEEDBACK_MODELS)}
+
+# ---------- Setup options ----------
+LEVELS = ("Junior", "Mid-level", "Senior")
+POSITIONS = ("Data Scientist", "Data Engineer", "ML Engineer", "BI Analyst", "Financial Analyst")
+COMPANIES = ("Amazon", "Meta", "Udemy", "365 Company", "Nestle", "LinkedIn", "Spotify")
+LEVEL_IDX = {v: i for i, v in enumerate(LEVELS)}
+POSITION_IDX = {v: i for i, v in enumerate(POSITIONS)}
+COMPANY_IDX = {v: i for i, v in enumerate(COMPANIES)}
+
+SIDEBAR_CSS = """
     <style>
     section[data-testid="stSidebar"] {
         width: 200px !important;   /* default is ~250px */
@@ -26,42 +71,99 @@ st.markdown(
         width: 200px !important;
     }
     </style>
-    """,
-    unsafe_allow_html=True,
-)
+    """
+
+# Installs a keydown listener in the parent Streamlit document (once per page load) that
+# presses the sidebar Stop button on ESC, so the normal request_stop callback handles it.
+ESC_LISTENER_HTML = """
+<script>
+(function () {
+    const doc = window.parent.document;
+    if (doc.getElementById("esc-stop-listener")) return;
+    const script = doc.createElement("script");
+    script.id = "esc-stop-listener";
+    script.textContent = `
+        document.addEventListener("keydown", (e) => {
+            if (e.key !== "Escape") return;
+            const buttons = document.querySelectorAll('section[data-testid="stSidebar"] button');
+            for (const b of buttons) {
+                if (b.innerText.includes("Stop") && !b.disabled) { b.click(); break; }
+            }
+        });
+    `;
+    doc.head.appendChild(script);
+})();
+</script>
+"""
+
+# ---------- Page config ----------
+st.set_page_config(page_title="StreamlitChatMessageHistory", page_icon="💬")
+# ---------- UI polish ----------
+# st.html skips markdown parsing and stays diff-stable across reruns (identical payload)
+st.html(SIDEBAR_CSS)
 st.title("Chatbot")
 st.caption("A minimal Streamlit interview simulator using OpenAI with Stop + feedback flow.")
 
 
 # ---------- Secrets & client setup (unified) ----------
-def get_required_secret(name: str) -> str:
-    """Return required secret from env (local) or st.secrets (Cloud); stop app with a helpful error if missing."""
+@st.cache_resource(show_spinner=False)
+def resolve_secret(name: str) -> str:
+    """Return secret from env (local) or st.secrets (Cloud); raise KeyError (uncached) if missing."""
     # Prefer env var locally (avoids StreamlitSecretNotFoundError in dev)
     value = os.getenv(name)
     if not value:
         try:
             value = st.secrets[name]  # Cloud
-        except Exception:
+        # No secrets file (StreamlitSecretNotFoundError subclasses FileNotFoundError) or no such key
+        except (FileNotFoundError, KeyError):
             value = None
-
     if not value:
+        raise KeyError(name)
+    return value
+
+
+def get_required_secret(name: str) -> str:
+    """Return required secret from env (local) or st.secrets (Cloud); stop app with a helpful error if missing."""
+    try:
+        return resolve_secret(name)
+    except KeyError:
         st.error(
             f"Missing required secret: {name}. "
             "Set it as an environment variable locally or in Streamlit Cloud (Advanced settings → Secrets)."
         )
         st.stop()
-    return value
 
 
 @st.cache_resource(show_spinner=False)
 def get_openai_client() -> OpenAI:
-    """Create and cache the OpenAI client using the resolved API key."""
+    """Create and cache the OpenAI client using the resolved API key.
+
+    A dedicated HTTP/2 httpx client keeps connections alive between interview turns,
+    so later requests skip the TCP/TLS handshake.
+    """
     api_key = get_required_secret("OPENAI_API_KEY")
-    return OpenAI(api_key=api_key)
+    # DefaultHttpxClient keeps the SDK's transport defaults (e.g. follow_redirects)
+    http_client = DefaultHttpxClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    return OpenAI(api_key=api_key, http_client=http_client, max_retries=API_MAX_RETRIES)
 
 
 client = get_openai_client()
 
+
+@st.cache_resource(show_spinner=False)
+def get_async_runtime() -> tuple[asyncio.AbstractEventLoop, AsyncOpenAI]:
+    """Start a long-lived background event loop with an AsyncOpenAI client that runs on it."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openai-async-loop", daemon=True).start()
+    http_client = DefaultAsyncHttpxClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    aclient = AsyncOpenAI(
+        api_key=get_required_secret("OPENAI_API_KEY"),
+        http_client=http_client,
+        max_retries=API_MAX_RETRIES,
+    )
+    return loop, aclient
+
+
 # ---------- Session state ----------
 defaults = {
     "setup_complete": False,
@@ -69,6 +171,12 @@ defaults = {
     "feedback_shown": False,
     "chat_complete": False,
     "messages": [],
+    # Same user/assistant message dicts as `messages`, minus the system prompt (for rendering)
+    "display_messages": [],
+    # Running "role: content" transcript, extended as messages are appended
+    "transcript_buf": "",
+    # UTF-8 encoding of transcript_buf for the download button; reset whenever it changes
+    "transcript_bytes": None,
     "name": "",
     "experience": "",
     "skills": "",
@@ -76,10 +184,18 @@ defaults = {
     "position": "Data Scientist",
     "company": "Amazon",
     "openai_model": "gpt-4.1-mini",
+    "feedback_model": "gpt-4.1-mini",
+    # Generated feedback and the hash of the transcript it was generated for, kept so
+    # reruns on the feedback screen don't call the API again for the same interview
+    "feedback_text": None,
+    "feedback_key": None,
     # Stop-control state
     "stop_requested": False,
     # mark if Stop was pressed before any user message
     "stopped_early": False,
+    # Set by the interview fragment before its completion rerun (see "Final chat")
+    "show_final_chat": False,
+    "stop_notice": False,
 }
 for k, v in defaults.items():
     if k not in st.session_state:
@@ -96,6 +212,76 @@ def show_feedback() -> None:
     st.session_state.feedback_shown = True
 
 
+def append_message(role: str, content: str) -> None:
+    """Append a chat message and extend the running transcript with it."""
+    message = {"role": role, "content": content}
+    st.session_state.messages.append(message)
+    if role != "system":
+        st.session_state.display_messages.append(message)
+    line = f"{role}: {content}"
+    if st.session_state.transcript_buf:
+        line = f"{st.session_state.transcript_buf}\n{line}"
+    st.session_state.transcript_buf = line
+    st.session_state.transcript_bytes = None
+
+
+def render_chat() -> None:
+    """Render prior chat (system prompt is never in display_messages)."""
+    for message in st.session_state.display_messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+
+def stream_deltas(stream, parts: list[str]) -> Iterator[str]:
+    """Yield batched deltas until the stream ends or Stop is requested; keep raw deltas in ``parts``."""
+    # Each yielded chunk re-renders the whole markdown, so deltas are joined into growing batches
+    batch: list[str] = []
+    batch_size = STREAM_MIN_BATCH
+    try:
+        # Leaving the block (Stop, error or rerun) closes the HTTP response, so the server stops generating
+        with stream:
+            for chunk in stream:
+                # Respect Stop from button or ESC
+                if st.session_state.stop_requested:
+                    break
+                # Chunks always carry `choices` (possibly empty) and `delta.content` may be None,
+                # so attribute access never raises; SDK/transport errors surface from the loop itself
+                choices = chunk.choices
+                if not choices:
+                    continue
+                delta = choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    batch.append(delta)
+                    if len(batch) >= batch_size:
+                        yield "".join(batch)
+                        batch = []
+                        batch_size = min(STREAM_MAX_BATCH, batch_size * STREAM_GROWTH_FACTOR)
+    except Exception:
+        # Show the unflushed tail before the error reaches the caller
+        if batch:
+            yield "".join(batch)
+        raise
+    if batch:
+        yield "".join(batch)
+
+
+def build_api_messages(messages: list[dict], k: int = API_HISTORY_WINDOW) -> list[dict]:
+    """Return the system prompt plus the last ``k`` messages, bounding prompt size per turn."""
+    return messages[:1] + messages[1:][-k:]
+
+
+@st.cache_data(show_spinner=False)
+def build_system_prompt(name: str, experience: str, skills: str, level: str, position: str, company: str) -> str:
+    """Build the interviewer system prompt for the given candidate and role."""
+    return (
+        f"You are an HR executive that interviews an interviewee called {name} "
+        f"with experience {experience} and skills {skills}. "
+        f"You should interview him for the position {level} {position} "
+        f"at the company {company}"
+    )
+
+
 def request_stop() -> None:
     """Stop interview; flag early stop if no user messages and end immediately."""
     st.session_state.stop_requested = True
@@ -133,26 +319,22 @@ if not st.session_state.setup_complete:
     with col1:
         st.session_state["level"] = st.radio(
             "Choose level",
-            options=["Junior", "Mid-level", "Senior"],
-            index=["Junior", "Mid-level", "Senior"].index(st.session_state["level"]),
+            options=LEVELS,
+            index=LEVEL_IDX[st.session_state["level"]],
             key="level_radio",
         )
     with col2:
         st.session_state["position"] = st.selectbox(
             "Choose a position",
-            ("Data Scientist", "Data Engineer", "ML Engineer", "BI Analyst", "Financial Analyst"),
-            index=("Data Scientist", "Data Engineer", "ML Engineer", "BI Analyst", "Financial Analyst").index(
-                st.session_state["position"]
-            ),
+            POSITIONS,
+            index=POSITION_IDX[st.session_state["position"]],
             key="position_select",
         )
 
     st.session_state["company"] = st.selectbox(
         "Select a Company",
-        ("Amazon", "Meta", "Udemy", "365 Company", "Nestle", "LinkedIn", "Spotify"),
-        index=("Amazon", "Meta", "Udemy", "365 Company", "Nestle", "LinkedIn", "Spotify").index(
-            st.session_state["company"]
-        ),
+        COMPANIES,
+        index=COMPANY_IDX[st.session_state["company"]],
         key="company_select",
     )
 
@@ -160,28 +342,78 @@ if not st.session_state.setup_complete:
         st.write("Setup complete. Starting interview...")
 
 # ---------- Interview phase ----------
+@st.fragment
+def interview_fragment() -> None:
+    """Render the chat and handle one interview turn (reruns on its own as a fragment)."""
+    # chat_input is inline in a fragment; new turns go into this container above it
+    history = st.container()
+    with history:
+        render_chat()
+
+    # Input loop limited to 5 user messages
+    if st.session_state.user_message_count < 5 and not st.session_state.stop_requested:
+        if prompt := st.chat_input("Your response", max_chars=1000):
+            with history:
+                append_message("user", prompt)
+                with st.chat_message("user"):
+                    st.markdown(prompt)
+
+                # Model responds for first 4 user messages (original logic)
+                if st.session_state.user_message_count < 4:
+                    try:
+                        with st.chat_message("assistant"):
+                            stream = client.chat.completions.create(
+                                model=st.session_state["openai_model"],
+                                # Sliding window over history; feedback still sees the full transcript
+                                messages=build_api_messages(st.session_state.messages),
+                                stream=True,
+                            )
+
+                            # st.write_stream handles incremental rendering of the deltas
+                            parts: list[str] = []
+                            try:
+                                st.write_stream(stream_deltas(stream, parts))
+                            except Exception as e:
+                                st.error(f"Assistant streaming failed: {e}")
+                            full_response = "".join(parts)
+
+                        # If user requested stop during streaming, mark interview complete
+                        if st.session_state.stop_requested:
+                            st.session_state.chat_complete = True
+                            st.session_state.stop_notice = True
+
+                        # Persist whatever was generated (even if empty)
+                        append_message("assistant", full_response)
+
+                    except Exception as e:
+                        st.error(f"Assistant response failed: {e}")
+
+            # Increment the user message count
+            st.session_state.user_message_count += 1
+
+    # End interview after 5 user messages or when stopped; full rerun shows the Feedback controls
+    if st.session_state.user_message_count >= 5 or st.session_state.stop_requested:
+        st.session_state.chat_complete = True
+        st.session_state.show_final_chat = True
+        st.rerun()
+
+
 if st.session_state.setup_complete and not st.session_state.feedback_shown and not st.session_state.chat_complete:
     st.info("Start by introducing yourself", icon="👋")
 
     # Initialize system message only once
     if not st.session_state.messages:
-        st.session_state.messages = [
-            {
-                "role": "system",
-                "content": (
-                    f"You are an HR executive that interviews an interviewee called {st.session_state['name']} "
-                    f"with experience {st.session_state['experience']} and skills {st.session_state['skills']}. "
-                    f"You should interview him for the position {st.session_state['level']} {st.session_state['position']} "
-                    f"at the company {st.session_state['company']}"
-                ),
-            }
-        ]
-
-    # Render prior chat (excluding system)
-    for message in st.session_state.messages:
-        if message["role"] != "system":
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+        append_message(
+            "system",
+            build_system_prompt(
+                st.session_state["name"],
+                st.session_state["experience"],
+                st.session_state["skills"],
+                st.session_state["level"],
+                st.session_state["position"],
+                st.session_state["company"],
+            ),
+        )
 
     # ---------- Stop controls (button + ESC) ----------
     # ---------- Controls (sidebar) ----------
@@ -194,89 +426,28 @@ if st.session_state.setup_complete and not st.session_state.feedback_shown and n
             help="Stop the current response",
             disabled=st.session_state.get("stop_requested", False)
         )
-
-    # ESC key listener via streamlit_js_eval (best-effort; safe to ignore if unsupported)
-    try:
-        esc_signal = streamlit_js_eval(
-            js_expressions=[
-                # Install a one-time keydown listener
-                """
-                if (!window.__stopEscListenerInstalled) {
-                    window.addEventListener('keydown', (e) => {
-                        if (e.key === 'Escape') {
-                            window.name = 'STOP_REQUESTED';
-                        }
-                    });
-                    window.__stopEscListenerInstalled = true;
-                }
-                'OK'
-                """,
-                # Read the flag
-                "window.name || ''"
-            ],
-            key="esc_listener"
+        st.session_state["feedback_model"] = st.selectbox(
+            "Feedback model",
+            FEEDBACK_MODELS,
+            index=FEEDBACK_MODEL_IDX[st.session_state["feedback_model"]],
+            key="feedback_model_select",
         )
-        if isinstance(esc_signal, list) and len(esc_signal) == 2 and esc_signal[1] == "STOP_REQUESTED":
-            st.session_state.stop_requested = True
-            if st.session_state.user_message_count == 0:
-                st.session_state.stopped_early = True
-            st.session_state.chat_complete = True
-    except Exception:
-        pass  # Non-fatal if JS eval is unavailable
 
-    # Input loop limited to 5 user messages
-    if st.session_state.user_message_count < 5 and not st.session_state.stop_requested:
-        if prompt := st.chat_input("Your response", max_chars=1000):
-            st.session_state.messages.append({"role": "user", "content": prompt})
-            with st.chat_message("user"):
-                st.markdown(prompt)
-
-            # Model responds for first 4 user messages (original logic)
-            if st.session_state.user_message_count < 4:
-                try:
-                    with st.chat_message("assistant"):
-                        stream = client.chat.completions.create(
-                            model=st.session_state["openai_model"],
-                            messages=[{"role": m["role"], "content": m["content"]} for m in st.session_state.messages],
-                            stream=True,
-                        )
-
-                        # Manual stream rendering with early-stop support
-                        placeholder = st.empty()
-                        full_response = ""
-                        try:
-                            for chunk in stream:
-                                # Respect Stop from button or ESC
-                                if st.session_state.stop_requested:
-                                    break
-                                # Extract streamed delta content (OpenAI Chat Completions stream)
-                                try:
-                                    delta = chunk.choices[0].delta.content
-                                except Exception:
-                                    delta = None
-                                if delta:
-                                    full_response += delta
-                                    placeholder.markdown(full_response)
-                        except Exception as e:
-                            st.error(f"Assistant streaming failed: {e}")
-
-                    # If user requested stop during streaming, mark interview complete
-                    if st.session_state.stop_requested:
-                        st.session_state.chat_complete = True
-                        st.info("Interview stopped by user.", icon="🛑")
-
-                    # Persist whatever was generated (even if empty)
-                    st.session_state.messages.append({"role": "assistant", "content": full_response})
-
-                except Exception as e:
-                    st.error(f"Assistant response failed: {e}")
+    # ESC key listener: the script lives in the parent document once injected, so the
+    # component only needs to render on the first interview run (no per-rerun JS round-trip)
+    if "esc_installed" not in st.session_state:
+        components.html(ESC_LISTENER_HTML, height=0)
+        st.session_state.esc_installed = True
 
-            # Increment the user message count
-            st.session_state.user_message_count += 1
+    interview_fragment()
 
-    # End interview after 5 user messages or when stopped
-    if st.session_state.user_message_count >= 5 or st.session_state.stop_requested:
-        st.session_state.chat_complete = True
+# ---------- Final chat ----------
+# Keep the finished chat visible on the rerun that ended the interview
+if st.session_state.show_final_chat:
+    st.session_state.show_final_chat = False
+    render_chat()
+    if st.session_state.stop_notice:
+        st.info("Interview stopped by user.", icon="🛑")
 
 # ---------- Get Feedback ----------
 if (
@@ -307,51 +478,45 @@ if st.session_state.feedback_shown:
         st.stop()
     st.subheader("Feedback")
 
-    conversation_history = "\n".join(
-        [f"{msg['role']}: {msg['content']}" for msg in st.session_state.messages]
-    )
+    # Running transcript maintained by append_message; shared by the feedback prompt and download
+    conversation_history = st.session_state.transcript_buf
+    # Keyed on model + transcript so switching the feedback model regenerates it
+    feedback_key = hashlib.sha256(
+        f"{st.session_state['feedback_model']}\n{conversation_history}".encode("utf-8")
+    ).hexdigest()
 
-    try:
-        feedback_completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a helpful tool that provides feedback on an interviewee performance. "
-                        "Before the Feedback give a score of 1 to 10.\n"
-                        "Follow this format:\n"
-                        "Overal Score: //Your score\n"
-                        "Feedback: //Here you put your feedback\n"
-                        "Give only the feedback do not ask any additional questins."
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": (
-                        "This is the interview you need to evaluate. "
-                        "Keep in mind that you are only a tool. "
-                        "And you shouldn't engage in any converstation: "
-                        f"{conversation_history}"
-                    ),
-                },
-            ],
-        )
-        st.write(feedback_completion.choices[0].message.content)
-    except Exception as e:
-        st.error(f"Feedback generation failed: {e}")
+    if st.session_state["feedback_text"] is not None and st.session_state["feedback_key"] == feedback_key:
+        st.markdown(st.session_state["feedback_text"])
+    else:
+        try:
+            loop, aclient = get_async_runtime()
+            feedback_stream = run_feedback(
+                aclient,
+                [
+                    {"role": "system", "content": FEEDBACK_SYSTEM},
+                    {"role": "user", "content": FEEDBACK_USER_PREFIX + conversation_history},
+                ],
+                st.session_state["feedback_model"],
+            )
+            # Same rendering path as the interview stream
+            feedback_text = st.write_stream(iter_in_loop(feedback_stream, loop))
+            st.session_state["feedback_text"] = feedback_text
+            st.session_state["feedback_key"] = feedback_key
+        except Exception as e:
+            st.error(f"Feedback generation failed: {e}")
 
     # Allow user to download full conversation as .txt
-    transcript = "\n".join([f"{m['role']}: {m['content']}" for m in st.session_state.messages])
+    if st.session_state.transcript_bytes is None:
+        st.session_state.transcript_bytes = conversation_history.encode("utf-8")
     st.download_button(
         label="Download Transcript",
-        data=transcript,
+        data=st.session_state.transcript_bytes,
         file_name="interview_transcript.txt",
-        mime="text/plain"
+        mime="text/plain; charset=utf-8"
     )
 
     if st.button("Restart Interview", type="primary"):
         streamlit_js_eval(js_expressions="parent.window.location.reload()")
 
 st.markdown("---")
-st.markdown(f"<small>v0.1 • Model: {st.session_state.get('openai_model','n/a')}</small>", unsafe_allow_html=True)
+st.html(f"<small>v0.1 • Model: {st.session_state.get('openai_model','n/a')}</small>")
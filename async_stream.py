@@ -0,0 +1,45 @@
+"""Async streaming helpers for the feedback request, driven from the Streamlit script thread."""
+
+import asyncio
+from collections.abc import AsyncGenerator, Iterator
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+
+async def run_feedback(aclient: "AsyncOpenAI", messages: list[dict], model: str) -> AsyncGenerator[str, None]:
+    """Yield text deltas of the interview feedback streamed by ``aclient``."""
+    stream = await aclient.chat.completions.create(model=model, messages=messages, stream=True)
+    async with stream:
+        async for chunk in stream:
+            # Extract streamed delta content (chunk shape is stable; see app.stream_deltas)
+            choices = chunk.choices
+            if not choices:
+                continue
+            delta = choices[0].delta.content
+            if delta:
+                yield delta
+
+
+async def _next_item(agen: AsyncGenerator[str, None]) -> str | None:
+    """Return the next item of ``agen``, or None once it is exhausted."""
+    try:
+        return await agen.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def _close(agen: AsyncGenerator[str, None]) -> None:
+    """Close ``agen`` so its ``async with`` blocks (e.g. the HTTP stream) exit."""
+    await agen.aclose()
+
+
+def iter_in_loop(agen: AsyncGenerator[str, None], loop: asyncio.AbstractEventLoop) -> Iterator[str]:
+    """Drive ``agen`` on ``loop`` from the calling thread as a sync iterator (for ``st.write_stream``)."""
+    try:
+        while (item := asyncio.run_coroutine_threadsafe(_next_item(agen), loop).result()) is not None:
+            yield item
+    finally:
+        # Close the stream (and its HTTP response) even on errors or early exit
+        asyncio.run_coroutine_threadsafe(_close(agen), loop).result()
@@ -0,0 +1,64 @@
+import asyncio
+import threading
+
+import pytest
+
+from async_stream import iter_in_loop
+
+
+class FakeStream:
+    """Async iterator standing in for a streamed response; records aclose()."""
+
+    def __init__(self, items, error=None):
+        self.items = list(items)
+        self.error = error
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.items:
+            return self.items.pop(0)
+        if self.error is not None:
+            raise self.error
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_iter_in_loop_exhausts_stream(loop):
+    stream = FakeStream(["a", "b", "c"])
+    assert list(iter_in_loop(stream, loop)) == ["a", "b", "c"]
+    assert stream.closed
+
+
+def test_iter_in_loop_propagates_error_and_closes(loop):
+    stream = FakeStream(["a"], error=ValueError("boom"))
+    received = []
+    with pytest.raises(ValueError, match="boom"):
+        for item in iter_in_loop(stream, loop):
+            received.append(item)
+    assert received == ["a"]
+    assert stream.closed
+
+
+def test_iter_in_loop_closes_on_early_exit(loop):
+    stream = FakeStream(["a", "b", "c"])
+    it = iter_in_loop(stream, loop)
+    assert next(it) == "a"
+    it.close()
+    assert stream.closed
+    assert stream.items == ["b", "c"]